@@ -13,32 +13,52 @@
   * Amenities
 
   This scraper loops through a list of URLs (as defined in the assignment) and produces a basic report
-  for each which is printed to screen. The URLs are defined as a list in the main function.
+  for each which is printed to screen. The URLs are read from 'sample_data.txt' in the main function, and
+  are fetched concurrently on a single thread using asyncio and an HTTP/2 httpx client.
 
-  The 'print_report' function could be replaced/supplemented by further methods of producing a report e.g.
-  writing to a file or database table, as a potential improvement.
+  Alternatively, with the '--ndjson' option, each report is written as one line of JSON to a file by the
+  'write_report' function. This could be supplemented by further methods of producing a report e.g.
+  writing to a database table, as a potential improvement.
 
   - - -
 
-  This module requires an XML/HTML parser, e.g. html5lib. lxml is faster for Linux, but is awkward to
-  install on Windows.
+  The bootstrap data is normally extracted from the page with a regular expression. selectolax, a fast
+  C-backed HTML parser, is used as a fallback where the regular expression finds no match.
 
 """
 
-from bs4 import BeautifulSoup
-from threading import Thread
-import requests
-import json
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+import argparse
+import asyncio
+import diskcache
+import gzip
+import httpx
+import multiprocessing
+import orjson
+import re
+import selectolax.lexbor
+import simdjson
+import sys
 import time
 
+# uvloop provides a faster event loop, but is not available on Windows
+try:
+    import uvloop
+
+except ImportError:
+    uvloop = None
 
 # ------------------------------------------------------------------------ #
 
 # Define headers for HTTP GET request. This ensures the request appears to be a valid request from a browser,
 # rather than an automated crawler which some sites may block or throttle.
 
+# No 'Connection' header is set, as connection-specific headers are not permitted over HTTP/2 and
+# the client keeps connections alive by default.
+
 headers = {
-    'Connection': 'Keep-Alive',
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
     'Accept-Encoding': 'gzip, deflate, br',
     'Accept-Language': 'en-GB,en-US;q=0.8,en;q=0.6',
@@ -46,39 +66,88 @@ headers = {
                   'Chrome/60.0.3112.90 Safari/537.36'
 }
 
-# Define a persistent session for requests, apply headers to this session:
-session = requests.Session()
-session.headers.update(headers)
+# Process pool for parsing pages, created on first use by 'get_process_pool' and reused by every call
+# to main, as starting worker processes is expensive. It is replaced if a worker process dies:
+process_pool = None
+
+# Directory for the on-disk page cache, and the number of seconds a cached page is used without
+# revalidating it with the server:
+cache_dir = '.airbnb_cache'
+cache_expiry = 3600
+
+# Retry failed requests up to 'max_retries' times, for responses with a status code in 'retry_statuses'
+# or for network errors. The delay before each retry doubles, starting from 'backoff_factor' seconds.
+# A delay requested by the server with 'Retry-After' is honoured up to 'max_retry_after' seconds:
+max_retries = 3
+backoff_factor = 0.5
+max_retry_after = 60
+retry_statuses = {429, 500, 502, 503, 504}
+
+# Match the script tag containing the bootstrap data JSON string in the raw page bytes, capturing
+# the contents of the HTML comment inside it:
+hypernova_re = re.compile(
+    rb'<script[^>]*data-hypernova-key="p3indexbundlejs"[^>]*>\s*<!--(.*?)-->\s*</script>',
+    re.DOTALL
+)
+
+# Map labels in the 'Space' section of the page data to keys in the summary data dictionary:
+space_labels = {
+    'Property type:': 'property_type',
+    'Bedrooms:': 'rooms',
+    'Bathrooms:': 'bathrooms'
+}
+
+# Key of the same script tag, used to check that a page contains the bootstrap data before caching it:
+hypernova_key = b'p3indexbundlejs'
+
+# CSS selector for the same script tag, for pages where the regex above finds no match:
+hypernova_selector = 'script[data-hypernova-key="p3indexbundlejs"][type="application/json"]'
+
+# Map amenity (category, is safety feature) pairs to keys in the summary data dictionary. Any
+# amenity not listed here is a general amenity:
+amenity_buckets = {
+    ('family', False): 'family_amenities',
+    ('family', True): 'family_amenities',
+    ('general', True): 'safety_feats'
+}
+
+# Define a reusable JSON parser. A simdjson parser can only hold one document at a time, so
+# documents it returns must not be kept alive beyond the report for a single page:
+json_parser = simdjson.Parser()
 
 # ------------------------------------------------------------------------ #
 
 
-def get_json_data(page_content, parser='html5lib'):
+def get_json_data(page_content):
 
     """ Scrape content from Airbnb property details pages, return page data as a
-    a Python dictionary.
+    a simdjson Object. Values are only converted to Python objects when accessed.
 
-    :param page_content: str
-        web page content, as a string
-    :param parser: str
-        specify the parser for BeautifulSoup to use, or set None to use system default
-    :return: dict
+    The bootstrap data is extracted with a regular expression, which avoids building a
+    DOM tree for the whole page. selectolax is only used if the regex finds no match.
+
+    :param page_content: bytes
+        web page content, as raw bytes
+    :return: simdjson.Object
         scraped page data
     """
 
-    page_data = BeautifulSoup(page_content, parser)
+    match = hypernova_re.search(page_content)
+
+    if match:
+        # Regex captures the JSON string inside the comment tags, parse using simdjson
+        return json_parser.parse(match.group(1))
 
     # Find the script tag containing the bootstrap data JSON string
-    data = page_data.find(
-        'script',
-        attrs={"data-hypernova-key": "p3indexbundlejs", "type": "application/json"}
-    )
+    data = selectolax.lexbor.LexborHTMLParser(page_content).css_first(hypernova_selector)
+
+    if data is None:
+        raise ValueError('bootstrap data not found in page')
 
-    # Extract tag contents, remove comment tags and convert to dict. using json module
-    tag_content = str(data.contents[0]).replace('<!--', '').replace('-->', '')
-    content_dict = json.loads(tag_content)
+    # Extract tag contents, remove comment tags and parse using simdjson
+    tag_content = data.text().strip().removeprefix('<!--').removesuffix('-->')
 
-    return content_dict
+    return json_parser.parse(tag_content.encode())
 
 
 def generate_report(data):
@@ -94,60 +163,133 @@ def generate_report(data):
      * 'family_amenities' - List of family amenities
      * 'safety_feats' - List of safety amenities
 
-    :param data: dict
+    :param data: simdjson.Object
         Web page data, derived from 'bootstrapData' JSON string
     :return: dict
         Summarised property information (see above)
     """
 
-    listing = data['bootstrapData']['listing']
-
     # Initialise summary data dictionary. Some values have been assigned default values of 'Not found'
     # in the event that the data is not present in the web page data
 
     summary_data = {
-        'property_name': listing['name'],
+        'property_name': data.at_pointer('/bootstrapData/listing/name'),
         'property_type': 'Not found',
         'rooms': 'Not found',
-        'bathrooms': 'Not found',
+        'bathrooms': 'Not found'
+    }
+
+    # Iterate through 'Space' section to build room details. Sections of the listing are looked up
+    # by JSON pointer, which avoids creating intermediate objects for 'bootstrapData' and 'listing'.
+    # Labels are looked up in a copy of 'space_labels', and removed once found so that the loop can
+    # stop as soon as all details have been found
+
+    remaining = dict(space_labels)
+
+    for detail in data.at_pointer('/bootstrapData/listing/space_interface'):
+        label = detail.get('label')
+        key = remaining.get(label)
+
+        if key and detail['value']:
+            summary_data[key] = detail['value']
+            del remaining[label]
+
+            if not remaining:
+                break
+
+    # Iterate through amenities to build list of amenities grouped by category. Each amenity is sorted
+    # into a local bucket, which is copied into the summary data once the loop completes
+
+    buckets = {
         'general_amenities': [],
         'family_amenities': [],
         'safety_feats': []
     }
 
-    # Iterate through 'Space' section to build room details
+    for amenity in data.at_pointer('/bootstrapData/listing/listing_amenities'):
+        if not amenity['is_present']:
+            continue
+
+        # Not every amenity has an 'is_safety_feature' value, treat a missing value as False
+        key = amenity_buckets.get(
+            (amenity['category'], bool(amenity.get('is_safety_feature'))), 'general_amenities'
+        )
+        buckets[key].append(amenity['name'])
 
-    for detail in listing['space_interface']:
+    summary_data.update(buckets)
 
-        if detail.get('label') == 'Property type:' and detail['value']:
-            summary_data['property_type'] = detail['value']
+    return summary_data
 
-        if detail.get('label') == 'Bedrooms:' and detail['value']:
-            summary_data['rooms'] = detail['value']
 
-        if detail.get('label') == 'Bathrooms:' and detail['value']:
-            summary_data['bathrooms'] = detail['value']
+def parse_and_summarize(page_content):
 
-    # Iterate through amenities to build list of amenities grouped by category
+    """ Parse web page content and compile into dictionary to be used for reporting. This is the
+    CPU-bound stage of the scraper, and is run in a separate process so that pages can be parsed
+    in parallel, while the event loop in the main process continues to retrieve pages.
 
-    for amenity in listing['listing_amenities']:
-        if amenity['is_present']:
+    :param page_content: bytes
+        web page content, as raw bytes
+    :return: dict
+        Summarised property information (see 'generate_report')
+    """
 
-            if amenity['category'] == 'family':
-                summary_data['family_amenities'].append(amenity['name'])
+    # The parsed document is not bound to a name, so it is released as soon as the report has been
+    # built and the parser can be reused for the next page.
+    return generate_report(get_json_data(page_content))
 
-            elif amenity['category'] == 'general' and amenity['is_safety_feature']:
-                summary_data['safety_feats'].append(amenity['name'])
 
-            else:
-                summary_data['general_amenities'].append(amenity['name'])
+def get_process_pool():
 
-    return summary_data
+    """ Return the process pool for parsing pages, creating it on first use. The pool is kept for
+    the life of the program, so that repeated calls to main reuse the same worker processes.
+
+    Worker processes are started with 'spawn' rather than forked, as they are started part way
+    through a run and would otherwise inherit the open page cache and output files.
+
+    :return: concurrent.futures.ProcessPoolExecutor
+        shared process pool
+    """
+
+    global process_pool
+
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+
+    return process_pool
+
+
+async def summarize_in_pool(page_content):
+
+    """ Run 'parse_and_summarize' in the shared process pool. If the pool is broken, e.g. because
+    a worker process was killed, it is replaced with a new pool and the page is retried once.
+
+    :param page_content: bytes
+        web page content, as raw bytes
+    :return: dict
+        Summarised property information (see 'generate_report')
+    """
+
+    global process_pool
+
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+
+    try:
+        return await loop.run_in_executor(pool, parse_and_summarize, page_content)
+
+    except BrokenProcessPool:
+        # Only replace the pool if another worker has not already done so
+        if process_pool is pool:
+            pool.shutdown(wait=False)
+            process_pool = None
+
+        return await loop.run_in_executor(get_process_pool(), parse_and_summarize, page_content)
 
 
 def print_report(report_data):
 
-    """ Report generator - prints report to screen.
+    """ Report generator - prints report to screen. The report is built up as a list of lines
+    and written to stdout in a single call, rather than one call per line.
 
     :param report_data: dict
         summary dictionary of property details
@@ -156,143 +298,303 @@ def print_report(report_data):
     """
 
     header = '\nPROPERTY SUMMARY FOR "{}"\n'.format(report_data['property_name'])
-    print('* ' * (len(header) // 2))
-    print(header)
+    lines = ['* ' * (len(header) // 2), header]
 
-    print('Property Type:'.ljust(25), report_data['property_type'])
-    print('Number of Bedrooms:'.ljust(25), report_data['rooms'])
-    print('Number of Bathrooms:'.ljust(25), report_data['bathrooms'])
+    lines.append('{} {}'.format('Property Type:'.ljust(25), report_data['property_type']))
+    lines.append('{} {}'.format('Number of Bedrooms:'.ljust(25), report_data['rooms']))
+    lines.append('{} {}'.format('Number of Bathrooms:'.ljust(25), report_data['bathrooms']))
 
     not_found = ['n/a']  # Print this if nothing found for category
 
-    print('\nAMENITIES:')
+    lines.append('\nAMENITIES:')
 
     for amenity in report_data['general_amenities']:
-        print(' * ', amenity)
+        lines.append(' *  {}'.format(amenity))
 
-    print('\nFAMILY AMENITIES:')
+    lines.append('\nFAMILY AMENITIES:')
 
     for amenity in report_data['family_amenities'] or not_found:
-        print(' * ', amenity)
+        lines.append(' *  {}'.format(amenity))
 
-    print('\nSAFETY FEATURES:')
+    lines.append('\nSAFETY FEATURES:')
 
     for amenity in report_data['safety_feats'] or not_found:
-        print(' * ', amenity)
+        lines.append(' *  {}'.format(amenity))
 
-    print('\n')
+    lines.append('\n')
+
+    sys.stdout.write('\n'.join(lines) + '\n')
 
     return
 
 
-def divide_list(input_list, n):
+def write_report(report_data, output):
 
-    """ Split a list into 'n' number of chunks of approximately equal length.
+    """ Report generator - writes report to file as a single line of JSON (NDJSON).
 
-    Based on example given here:
-        https://stackoverflow.com/questions/2130016/splitting-a-list-of-into-n-parts-of-approximately-equal-length
+    :param report_data: dict
+        summary dictionary of property details
+    :param output: file
+        file object opened in binary mode
+    :return: None
 
-    :param input_list: list
-        list to be split
-    :param n: int
-        number of chunks to split list into
-    :return: list
-        list of lists (chunks)
     """
 
-    avg = len(input_list) / float(n)
-    last = 0.0
-    divided = []
-
-    while last < len(input_list):
-        divided.append(input_list[int(last):int(last + avg)])
-        last += avg
+    output.write(orjson.dumps(report_data) + b'\n')
 
-    return divided
+    return
 
 # ------------------------------------------------------------------------ #
 
 
-class Scraper(Thread):
+async def get_with_retry(client, url, request_headers):
+
+    """ Send a GET request, retrying with exponential backoff for rate limiting responses,
+    server errors and network errors.
+
+    :param client: httpx.AsyncClient
+        persistent HTTP/2 client, with request headers applied
+    :param url: str
+        URL of web page to retrieve
+    :param request_headers: dict
+        additional headers for this request
+    :return: httpx.Response
+        final response received
+    """
+
+    for attempt in range(max_retries + 1):
+        delay = backoff_factor * 2 ** attempt
+
+        try:
+            response = await client.get(url, headers=request_headers)
+
+        except httpx.TransportError:
+            if attempt == max_retries:
+                raise
+
+        else:
+            if response.status_code not in retry_statuses or attempt == max_retries:
+                return response
+
+            # Honour the server's requested delay, where given as a number of seconds. The delay is
+            # capped, so that a very long 'Retry-After' cannot stall the worker and the whole run
+            retry_after = response.headers.get('Retry-After', '')
+
+            if retry_after.isdigit():
+                delay = min(int(retry_after), max_retry_after)
 
-    """ Subclass of Thread :-
-    Defines a thread worker for running the scraper. Spawn one Scraper instance per
-    thread to be executed - each thread can accept either a URL or a list of URLs to
-    iterate through.
+        await asyncio.sleep(delay)
 
+
+def store_page(cache, url, etag, last_modified, page_content):
+
+    """ Store a retrieved page in the on-disk cache, gzipped. Pages which do not contain the bootstrap
+    data script tag, e.g. a bot check or other interstitial page, are not stored, so that they are
+    requested again on the next run rather than served from the cache.
+
+    :param cache: diskcache.Cache
+        on-disk page cache
+    :param url: str
+        URL of web page
+    :param etag: str or None
+        'ETag' header of the response
+    :param last_modified: str or None
+        'Last-Modified' header of the response
+    :param page_content: bytes
+        web page content, as raw bytes
+    :return: None
     """
 
-    def __init__(self, urls):
+    if hypernova_key not in page_content:
+        return
+
+    cache.set(url, (time.time(), etag, last_modified, gzip.compress(page_content, compresslevel=1)))
+
+
+async def fetch(client, cache, url):
+
+    """ Retrieve a web page using the shared HTTP client. Pages are stored gzipped in an
+    on-disk cache, keyed on URL. Cached pages younger than 'cache_expiry' are returned without
+    a request; older pages are revalidated using their ETag/Last-Modified headers, and reused
+    if the server responds '304 Not Modified'.
+
+    Cache reads and writes, and gzip compression, are blocking, so they are run in the event
+    loop's default thread pool rather than on the event loop itself.
+
+    :param client: httpx.AsyncClient
+        persistent HTTP/2 client, with request headers applied
+    :param cache: diskcache.Cache
+        on-disk page cache
+    :param url: str
+        URL of web page to retrieve
+    :return: tuple
+        HTTP status code and web page content, as raw bytes
+    """
+
+    loop = asyncio.get_running_loop()
+    cached = await loop.run_in_executor(None, cache.get, url)
+    request_headers = {}
+
+    if cached is not None:
+        stored, etag, last_modified, body = cached
+
+        if time.time() - stored < cache_expiry:
+            return 200, await loop.run_in_executor(None, gzip.decompress, body)
+
+        if etag:
+            request_headers['If-None-Match'] = etag
+
+        if last_modified:
+            request_headers['If-Modified-Since'] = last_modified
+
+    response = await get_with_retry(client, url, request_headers)
+
+    if response.status_code == 304 and cached is not None:
+        await loop.run_in_executor(None, cache.set, url, (time.time(), etag, last_modified, body))
+        return 200, await loop.run_in_executor(None, gzip.decompress, body)
+
+    # Use the raw response bytes, rather than decoding the page to a string which would only be
+    # encoded again for parsing
+    page_content = response.content
+
+    if response.status_code == 200:
+        await loop.run_in_executor(
+            None, store_page, cache, url,
+            response.headers.get('ETag'), response.headers.get('Last-Modified'), page_content
+        )
 
-        super(Scraper, self).__init__()
+    return response.status_code, page_content
 
-        # Ensure URL list is of list type:
-        if type(urls) is str:
-            self.urls = [urls]
+
+async def handle(client, cache, url, output):
+
+    """ Retrieve a single URL, parse and print or write report.
+
+    :param client: httpx.AsyncClient
+        persistent HTTP/2 client, with request headers applied
+    :param cache: diskcache.Cache
+        on-disk page cache
+    :param url: str
+        URL of web page to scrape
+    :param output: file or None
+        file to write NDJSON report to, or None to print report to screen
+    :return: None
+    """
+
+    try:
+        print(url)
+        status, page_content = await fetch(client, cache, url)
+
+        if status != 200:
+            print('Failed to retrieve page, URL: {0}, error: {1}\n'.format(url, status))
+            return
+
+        # Get web page data from HTML response and compile into dictionary to be used for
+        # reporting, in the process pool
+        summary_data = await summarize_in_pool(page_content)
+
+        # Generate/print report
+        if output is None:
+            print_report(summary_data)
 
         else:
-            self.urls = urls
+            write_report(summary_data, output)
+
+    except Exception as error:
+        print('Scraper failed to run for URL {0}, error: {1}, {2}\n'.format(
+            url, type(error).__name__, error
+        ))
+
+
+async def produce(queue, path, no_workers):
+
+    """ Read URLs from a file one line at a time and add them to the shared work queue, followed
+    by one None sentinel per worker. As the queue is bounded, the file is read only as fast as
+    the workers take URLs from the queue, and scraping starts before the whole file is read.
 
-    def run(self):
+    :param queue: asyncio.Queue
+        work queue of URLs, shared between all workers
+    :param path: str
+        file containing one URL per line
+    :param no_workers: int
+        number of workers consuming the queue
+    :return: None
+    """
 
-        """ Iterate through URLs supplied, parse and print report.
+    with open(path, 'r') as f:
+        for line in f:
+            url = line.strip()
 
-        :return: None
-        """
+            # Skip blank lines, e.g. a trailing newline at the end of the file
+            if url:
+                await queue.put(url)
 
-        for url in self.urls:
-            try:
-                # Use requests to retrieve web page data
-                print(url)
-                response = session.get(url, )  # allow_redirects=True)
+    for _ in range(no_workers):
+        await queue.put(None)
 
-                if response.status_code != 200:
-                    print('Failed to retrieve page, URL: {0}, error: {1}\n'.format(url, response.status_code))
-                    return
 
-                # Get web page data from HTML response
-                content = get_json_data(response.text)
+async def worker(queue, client, cache, output):
 
-                # Compile data into dictionary to be used for reporting
-                summary_data = generate_report(content)
+    """ Take URLs from the shared work queue and scrape them one at a time, until a None
+    sentinel is received. As every worker takes the next URL as soon as it is free, work is
+    spread evenly across workers however long each page takes to retrieve.
 
-                # Generate/print report
-                print_report(summary_data)
+    :param queue: asyncio.Queue
+        work queue of URLs, shared between all workers
+    :param client: httpx.AsyncClient
+        persistent HTTP/2 client, with request headers applied
+    :param cache: diskcache.Cache
+        on-disk page cache
+    :param output: file or None
+        file to write NDJSON reports to, or None to print reports to screen
+    :return: None
+    """
 
-            except Exception as error:
-                print('Scraper failed to run for URL {0}, error: {1}, {2}\n'.format(
-                    url, type(error).__name__, error
-                ))
+    while True:
+        url = await queue.get()
 
-            # time.sleep(1)  # for load concerns
+        if url is None:
+            return
+
+        await handle(client, cache, url, output)
 
 # ------------------------------------------------------------------------ #
 
 
-def main():
+async def main(ndjson_path=None):
+
+    """ Scrape all URLs in 'sample_data.txt'.
+
+    :param ndjson_path: str or None
+        file to append NDJSON reports to, or None to print reports to screen
+    :return: None
+    """
+
     start_time = time.time()
 
-    # Read in data from file and split on return carriages.
-    with open('sample_data.txt', 'r') as f:
-        urls = f.read().split('\n')
+    # Number of workers, i.e. the maximum number of requests in flight at once. All workers run
+    # on a single thread, so this can be much higher than a sensible number of threads. Measuring
+    # and testing is the way forward with deciding this value.
+    no_workers = 50
 
-    # Number of threads to spawn. This can be equal to the number of URLs to spawn one thread
-    # per URL, however this should be reduced for a large number of URLs. Measuring and testing
-    # id the way forward with deciding this value.
-    no_threads = 6
+    # Work queue, filled with URLs from file as the workers consume it
+    queue = asyncio.Queue(maxsize=no_workers)
 
-    # Split URL list down into equal number of chunks to number of threads:
-    chunks = divide_list(urls, no_threads)
+    limits = httpx.Limits(max_connections=no_workers)
 
-    # Create list of thread workers
-    threads = [Scraper(chunks[x])for x in range(no_threads)]
+    # Persistent client shared by all requests, with headers applied to the client. Over HTTP/2,
+    # requests to the same host are multiplexed over a single TLS connection.
+    client = httpx.AsyncClient(headers=headers, http2=True, limits=limits)
 
-    # Start threads, wait for threads to complete before function returns
-    for t in threads:
-        t.start()
+    # All workers run on a single thread, so they can share one output file without a lock
+    output_file = open(ndjson_path, 'ab') if ndjson_path else nullcontext()
 
-    for t in threads:
-        t.join()
+    async with client:
+        with diskcache.Cache(cache_dir) as cache, output_file as output:
+            await asyncio.gather(
+                produce(queue, 'sample_data.txt', no_workers),
+                *(worker(queue, client, cache, output) for _ in range(no_workers))
+            )
 
     print('Execution time: ', time.time() - start_time)
 
@@ -300,4 +602,15 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    arg_parser = argparse.ArgumentParser(description='Scrape Airbnb property pages listed in sample_data.txt')
+    arg_parser.add_argument(
+        '--ndjson', metavar='PATH',
+        help='append one line of JSON per property to PATH, instead of printing reports to screen'
+    )
+    args = arg_parser.parse_args()
+
+    if uvloop is not None:
+        uvloop.run(main(args.ndjson))
+
+    else:
+        asyncio.run(main(args.ndjson))